@@ -5,8 +5,10 @@ Authors: Joshua Scheck
 Version: 2022-11-22
 """
 from datetime import datetime
-import math
-from typing import Dict, List, NamedTuple
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from numba import njit
+import numpy as np
 
 
 # Constant representing infinity
@@ -18,6 +20,128 @@ class QuoteData(NamedTuple):
     timestamp: datetime
     # Exchange rate for the quote
     exch_rate: float
+    # Negative logarithm of the exchange rate, used as the edge weight
+    neg_log_rate: float
+
+
+@njit(cache=True)
+def _relax(
+    indptr: np.ndarray,
+    indices: np.ndarray,
+    weights: np.ndarray,
+    distance: np.ndarray,
+    predecessor: np.ndarray,
+    start_vertex: int,
+    tolerance: float
+) -> int:
+    """
+    Updates vertex weights of a CSR graph to allow for optimizing shortest
+    path. Compiled with Numba as this is the hot loop of the algorithm.
+
+    Uses the Shortest Path Faster Algorithm, a queue based Bellman Ford
+    variant, where only the outgoing edges of vertices whose distance changed
+    are relaxed. Only relaxations resulting in an improvement greater than
+    tolerance are considered.
+
+    Args:
+        indptr (np.ndarray): Offsets of each vertex's outgoing edges.
+        indices (np.ndarray): Destination vertex of each edge.
+        weights (np.ndarray): Weight of each edge.
+        distance (np.ndarray): Distance of each vertex, updated in place.
+        predecessor (np.ndarray): Predecessor of each vertex, updated in
+            place.
+        start_vertex (int): Vertex to derrive shortest paths from every 
+            other vertex for. -1 designates a virtual source with a zero
+            weight edge to every vertex, whose distances must already be 0.
+        tolerance (float): Thresholding value, which ensures that path 
+            improvements must be greater than this value in order to be
+            relaxed.
+
+    Returns:
+        int: Vertex that was queued more often than a shortest path has
+            edges, which indicates a negative cycle, otherwise -1.
+    """
+    num_vertices = len(indptr) - 1
+
+    # Ring buffer of vertices to visit, each vertex is queued at most once
+    queue = np.empty(num_vertices, dtype=np.int32)
+    in_queue = np.zeros(num_vertices, dtype=np.bool_)
+    queue_count = np.zeros(num_vertices, dtype=np.int32)
+
+    if start_vertex == -1:
+        # Paths from the virtual source have at most V edges
+        max_queue_count = num_vertices + 1
+
+        for vertex in range(num_vertices):
+            queue[vertex] = vertex
+            in_queue[vertex] = True
+            queue_count[vertex] = 1
+
+        size = num_vertices
+    else:
+        # Shortest paths have at most V - 1 edges
+        max_queue_count = num_vertices
+
+        queue[0] = start_vertex
+        in_queue[start_vertex] = True
+        queue_count[start_vertex] = 1
+        size = 1
+
+    head = 0
+
+    while size > 0:
+        curr1 = queue[head]
+        head = (head + 1) % num_vertices
+        size -= 1
+        in_queue[curr1] = False
+
+        for edge in range(indptr[curr1], indptr[curr1 + 1]):
+            curr2 = indices[edge]
+            new_distance = distance[curr1] + weights[edge]
+
+            # Relax when collective distance is improved by more than
+            # tolerance, which also holds when curr2 has not been reached
+            if new_distance + tolerance < distance[curr2]:
+                distance[curr2] = new_distance
+                predecessor[curr2] = curr1
+
+                if not in_queue[curr2]:
+                    queue[(head + size) % num_vertices] = curr2
+                    in_queue[curr2] = True
+                    size += 1
+                    queue_count[curr2] += 1
+
+                    # A vertex is queued at most once per edge of its
+                    # shortest path, so queueing it more often can only be
+                    # caused by a negative cycle
+                    if queue_count[curr2] >= max_queue_count:
+                        return curr2
+
+    return -1
+
+
+@njit(cache=True)
+def _walk_predecessors(
+    predecessor: np.ndarray, vertex: int, steps: int
+) -> int:
+    """
+    Follows the predecessor chain of a vertex for the given number of steps.
+
+    Args:
+        predecessor (np.ndarray): Predecessor of each vertex.
+        vertex (int): Vertex to start walking from.
+        steps (int): Number of predecessors to follow.
+
+    Returns:
+        int: The vertex reached, or -1 if the chain ended early.
+    """
+    for _ in range(steps):
+        vertex = predecessor[vertex]
+
+        if vertex == -1:
+            break
+
+    return vertex
 
 
 class BellmandFord:
@@ -33,139 +157,286 @@ class BellmandFord:
         """
         Constructor for the BellmandFord class.
         """
-        self._graph = self._construct_graph(published_quotes)
-        self._distance = {}
-        self._predecessor = {}
+        self._names: List[str] = []
+        self._idx: Dict[str, int] = {}
+        self._currencies: Set[str] = set()
+        self._quotes: Dict[Tuple[str, str], QuoteData] = {}
+        self._pairs: Dict[Tuple[str, str], int] = {}
+        self._edge_positions: np.ndarray = None
+        self._indptr: np.ndarray = None
+        self._indices: np.ndarray = None
+        self._weights: np.ndarray = None
+        self._distance: np.ndarray = None
+        self._predecessor: np.ndarray = None
+        self._topology_changed = True
         self._tolerance = None
         self._latest_relaxed_vertex = None
 
-    def _construct_graph(
+        self.update(published_quotes)
+
+    @staticmethod
+    def _orient_quote(
+        curr1: str, curr2: str, quote: QuoteData
+    ) -> Tuple[Tuple[str, str], QuoteData]:
+        """
+        Expresses a quote in terms of the alphabetically ordered currency
+        pair, inverting the exchange rate if needed.
+
+        Args:
+            curr1 (str): Currency the quote trades from.
+            curr2 (str): Currency the quote trades into.
+            quote (QuoteData): Published quote.
+
+        Returns:
+            Tuple[Tuple[str, str], QuoteData]: The ordered currency pair and
+                the quote for that direction.
+        """
+        if curr1 > curr2:
+            return (curr2, curr1), QuoteData(
+                quote.timestamp, 1 / quote.exch_rate, -quote.neg_log_rate
+            )
+
+        return (curr1, curr2), quote
+
+    def _latest_quotes(
         self, published_quotes: Dict[str, Dict[str, QuoteData]]
-    ) -> Dict[str, Dict[str, float]]:
+    ) -> Tuple[Set[str], Dict[Tuple[str, str], QuoteData]]:
         """
-        Generates a weighted graph from the published forex quotes.
+        Collects the currencies and the most recent quote of every currency
+        pair from the published forex quotes.
 
         Args:
             published_quotes (Dict[str, Dict[str, QuoteData]]): Published 
-                forex quotes to generate a weighted graph from. Assumes that
-                no stale data is present.
+                forex quotes to collect from.
 
         Returns:
-            Dict[str, Dict[str, float]]: Generated weighted graph.
+            Tuple[Set[str], Dict[Tuple[str, str], QuoteData]]: The currencies
+                and the latest quote keyed by the alphabetically ordered
+                currency pair.
         """
-        graph = {}
+        currencies = set()
+
+        # Keep only the most recent quote per currency pair, as a quote and
+        # its reverse quote both yield the same pair of edges
+        latest: Dict[Tuple[str, str], QuoteData] = {}
 
         for curr1, nested_dict in published_quotes.items():
-            for curr2, (_, exch_rate) in nested_dict.items():
-                
-                # Create nested dictionary if none exists for curr1
-                if curr1 not in graph:
-                    graph[curr1] = {}
-                
-                # Create nested dictionary if none exists for currr2
-                if curr2 not in graph:
-                    graph[curr2] = {}
+            currencies.add(curr1)
+            currencies.update(nested_dict)
 
-                graph[curr1][curr2] = -1 * math.log(exch_rate)
-                graph[curr2][curr1] = math.log(exch_rate)
+            for curr2, quote in nested_dict.items():
+                pair, quote = self._orient_quote(curr1, curr2, quote)
+                prev_quote = latest.get(pair)
 
-        return graph
+                if prev_quote is None or\
+                    prev_quote.timestamp < quote.timestamp:
+                    latest[pair] = quote
 
-    def _distance_improved(self, curr1: str, curr2: str) -> bool:
+        return currencies, latest
+
+    def _edge_weights(
+        self, latest: Dict[Tuple[str, str], QuoteData]
+    ) -> np.ndarray:
         """
-        Determines if collective distance is improved and is greater than the
-        specified threshold.
+        Gathers the edge weights of every encapsulated currency pair, in the
+        order the pairs were inserted into the graph.
 
         Args:
-            curr1 (str): First currency vertex.
-            curr2 (str): Second currency vertex
+            latest (Dict[Tuple[str, str], QuoteData]): Latest quote of every
+                currency pair.
 
         Returns:
-            bool: True if distance improved and is greater than the specified 
-                threshold, otherwise False.
+            np.ndarray: The forward edge weights followed by the reverse edge
+                weights.
         """
-        # Calculate potential distance improvment
-        relaxation = self._distance[curr1]\
-            + self._graph[curr1][curr2]
-        
-        prev_distance = self._distance[curr2]
-        new_distance = relaxation
-
-        # Only relax when collective distance is improved and is
-        # greater than specified tolerance
-        if (prev_distance - new_distance) > self._tolerance:
-            self._distance[curr2] = self._distance[curr1] +\
-                self._graph[curr1][curr2]
-            self._predecessor[curr2] = curr1
-            return True
+        neg_log_rates = np.fromiter(
+            (latest[pair].neg_log_rate for pair in self._pairs),
+            dtype=np.float64,
+            count=len(self._pairs)
+        )
 
-        return False
+        # Each quote yields an edge of -log(rate) and a reverse edge of
+        # log(rate)
+        return np.concatenate((neg_log_rates, -neg_log_rates))
 
-    def _should_relax(self, curr1: str, curr2: str) -> bool:
+    def _construct_graph(
+        self, currencies: Set[str], latest: Dict[Tuple[str, str], QuoteData]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         """
-        Determines if the vertex pair should be relaxed.
+        Generates a weighted graph from the published forex quotes.
 
-        Relaxation may occur if:
-        1) Distance of curr2 is infinite and curr1 is not infinite. This should
-        indicate that curr2 > curr1.
-        2) Collective distance is improved and is greater than specified 
-        tolerance.
+        The graph is stored in compressed sparse row (CSR) form, where the
+        outgoing edges of vertex i are indices[indptr[i]:indptr[i+1]] with the
+        matching weights[indptr[i]:indptr[i+1]]. Vertices are identified by
+        their position in the sorted list of currency names.
 
         Args:
-            curr1 (str): First currency vertex.
-            curr2 (str): Second currency vertex
+            currencies (Set[str]): Currencies to use as vertices.
+            latest (Dict[Tuple[str, str], QuoteData]): Latest quote of every
+                currency pair. Assumes that no stale data is present.
 
         Returns:
-            bool: True if the vertex pair should be relaxed.
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: The indptr, indices and
+                weights arrays of the generated weighted graph.
         """
-        # Indicates that self._distance[curr2] has not been set
-        if self._distance[curr1] != INF and\
-            self._distance[curr2] == INF:
-            return True
-        
-        return self._distance_improved(curr1, curr2)
+        self._names = sorted(currencies)
+        self._idx = {curr: idx for idx, curr in enumerate(self._names)}
+        self._pairs = {pair: slot for slot, pair in enumerate(latest)}
+
+        src = np.asarray(
+            [self._idx[curr1] for curr1, _ in self._pairs], dtype=np.int32
+        )
+        dest = np.asarray(
+            [self._idx[curr2] for _, curr2 in self._pairs], dtype=np.int32
+        )
+
+        weights = self._edge_weights(latest)
+        src, dest = np.concatenate((src, dest)), np.concatenate((dest, src))
+
+        # Group edges by their source vertex
+        order = np.argsort(src, kind="stable")
+        indptr = np.searchsorted(
+            src[order], np.arange(len(self._names) + 1)
+        ).astype(np.int32)
+
+        # Remember where each edge ended up to allow for updating weights
+        self._edge_positions = np.empty_like(order)
+        self._edge_positions[order] = np.arange(len(order))
+
+        return indptr, dest[order], weights[order]
+
+    def update(
+        self, published_quotes: Dict[str, Dict[str, QuoteData]]
+    ) -> None:
+        """
+        Updates the encapsulated weighted graph to the published forex quotes.
+
+        The graph is only rebuilt when the set of currencies or currency pairs
+        changed, otherwise just the edge weights are recomputed in place.
+
+        Args:
+            published_quotes (Dict[str, Dict[str, QuoteData]]): Published 
+                forex quotes to update the weighted graph from. Assumes that
+                no stale data is present.
+        """
+        currencies, latest = self._latest_quotes(published_quotes)
+
+        if not self._topology_changed and currencies == self._currencies\
+            and latest.keys() == self._pairs.keys():
+            self._quotes = latest
+            self._weights[self._edge_positions] = self._edge_weights(latest)
+            return
+
+        self._currencies = currencies
+        self._quotes = latest
+        self._rebuild_graph()
+
+    def upsert_edge(self, curr1: str, curr2: str, quote: QuoteData) -> None:
+        """
+        Inserts or updates the pair of edges between two currencies.
+
+        Edges of a known currency pair are updated in place, while a new
+        currency pair is added to the graph before the next search.
+
+        Args:
+            curr1 (str): Currency the quote trades from.
+            curr2 (str): Currency the quote trades into.
+            quote (QuoteData): Published quote for the currency pair.
+        """
+        pair, quote = self._orient_quote(curr1, curr2, quote)
+        self._quotes[pair] = quote
+
+        slot = self._pairs.get(pair)
+
+        if slot is None or self._topology_changed:
+            self._currencies.update(pair)
+            self._topology_changed = True
+            return
+
+        weight = quote.neg_log_rate
+        self._weights[self._edge_positions[slot]] = weight
+        self._weights[self._edge_positions[slot + len(self._pairs)]] = -weight
+
+    def remove_edge(self, curr1: str, curr2: str) -> None:
+        """
+        Removes the pair of edges between two currencies before the next
+        search. The currencies themselves remain in the graph.
+
+        Args:
+            curr1 (str): First currency of the pair.
+            curr2 (str): Second currency of the pair.
+        """
+        pair = (curr1, curr2) if curr1 < curr2 else (curr2, curr1)
+
+        if self._quotes.pop(pair, None) is not None:
+            self._topology_changed = True
+
+    def _rebuild_graph(self) -> None:
+        """
+        Rebuilds the weighted graph from the encapsulated quotes, after
+        currencies or currency pairs were added or removed.
+        """
+        self._indptr, self._indices, self._weights = self._construct_graph(
+            self._currencies, self._quotes
+        )
+        self._distance = np.full(len(self._names), INF)
+        self._predecessor = np.full(len(self._names), -1, dtype=np.int32)
+        self._topology_changed = False
 
     def _initialize_vertex_data(
-        self, start_vertex: str
+        self, start_vertex: int
     ) -> None:
         """
-        Initializes the encapsulated distance and predecessor dictionaries.
+        Initializes the encapsulated distance and predecessor arrays.
 
         Args:
-            start_vertex (str): Vertex to derrive shortest paths from every 
-                other vertex for.
+            start_vertex (int): Vertex to derrive shortest paths from every 
+                other vertex for, or -1 to derrive them from a virtual source
+                connected to every vertex.
         """
-        for curr1 in self._graph:
-            self._distance[curr1] = INF 
-            self._predecessor[curr1] = None
-        
+        # Reuse the arrays allocated for the graph rather than reallocating
+        # them for every search
+        self._predecessor.fill(-1)
+
+        # Every vertex is at distance 0 from the virtual source
+        if start_vertex == -1:
+            self._distance.fill(0)
+            return
+
+        self._distance.fill(INF)
         self._distance[start_vertex] = 0
 
-    def _relax_edges(self) -> None:
+    def _edge_weight(self, curr1: int, curr2: int) -> float:
         """
-        Updates vertex weights to allow for optimizing shortest path.
+        Retrieves the weight of the edge from curr1 to curr2.
+
+        Args:
+            curr1 (int): First currency vertex.
+            curr2 (int): Second currency vertex
 
-        Only relaxations resulting in an improvement greater than tolerance 
-        are considered. 
+        Returns:
+            float: Weight of the edge.
         """
-        for _ in range(len(self._graph) - 1):
-            for curr1 in self._graph:
-                for curr2 in self._graph[curr1]:
-                    if self._should_relax(curr1, curr2):
-                        self._distance[curr2] = self._distance[curr1] +\
-                            self._graph[curr1][curr2]
-                        self._predecessor[curr2] = curr1
-                        
-    def _identify_neg_cycle(self, start_vertex: str) -> List[str]:
+        start, end = self._indptr[curr1], self._indptr[curr1 + 1]
+        edge = start + np.flatnonzero(self._indices[start:end] == curr2)[-1]
+        return self._weights[edge]
+
+    def _identify_neg_cycle(self, start_vertex: int) -> List[int]:
         """
         Identifies the start of a negative cycle.
 
         Returns:
-            List[str]: The identified negative cycle, where the first and last
-                element have the same value.
+            List[int]: The identified negative cycle, where the first and last
+                element have the same value. Empty if the predecessor chain
+                does not lead into a negative cycle.
         """
-        for _ in range(len(self._graph.keys())):
-            start_vertex = self._predecessor[start_vertex]
+        start_vertex = _walk_predecessors(
+            self._predecessor, start_vertex, len(self._names)
+        )
+
+        # Predecessor chain ended before reaching a cycle
+        if start_vertex == -1:
+            return []
 
         neg_cycle = []
         next_curr = start_vertex
@@ -183,9 +454,7 @@ class BellmandFord:
         neg_cycle.reverse()
 
         for idx in range(len(neg_cycle) - 1):
-            curr = neg_cycle[idx]
-            next_curr = neg_cycle[idx+1]
-            weight_sum += self._graph[curr][next_curr]
+            weight_sum += self._edge_weight(neg_cycle[idx], neg_cycle[idx+1])
 
         # Ensure that weighted sum is negative
         if weight_sum <= (-1 * self._tolerance):
@@ -203,38 +472,56 @@ class BellmandFord:
         Returns:
             List[str]: Identified negative cycle, otherwise an empty list.
         """
-        for curr1 in self._graph:
-            for curr2 in self._graph[curr1]:
-                if self._distance[curr1] != INF and\
-                    self._distance[curr2] < self._distance[curr1]\
-                   + self._graph[curr1][curr2]:
-                    try:
-                        return self._identify_neg_cycle(curr2)
-                    except KeyError:
-                        pass
-        return []
+        # Relaxation converged before proving a negative cycle
+        if self._latest_relaxed_vertex == -1:
+            return []
+
+        # The vertex relaxed too often is on, or reachable from, the cycle
+        neg_cycle = self._identify_neg_cycle(self._latest_relaxed_vertex)
+
+        return [self._names[idx] for idx in neg_cycle]
 
-    def shortest_paths(self, start_vertex: str, tolerance: float=1e-8) -> None:
+    def shortest_paths(
+        self, start_vertex: Optional[str]=None, tolerance: float=1e-8
+    ) -> None:
         """
         Determines the shortest paths (sum of edge weights) from the specified
         vertex to every other vertex. 
 
+        Without a start vertex, the paths start from a virtual source with a
+        zero weight edge to every vertex. A single search then reveals a
+        negative cycle anywhere in the graph.
+
         Args:
-            start_vertex (str): Vertex to derrive shortest paths from every 
-                other vertex for.
+            start_vertex (Optional[str]): Vertex to derrive shortest paths
+                from every other vertex for.
             tolerance (int): Thresholding value, which ensures that path 
                 improvements must be greater than this value in order to be
                 relaxed.
         """
+        if self._topology_changed:
+            self._rebuild_graph()
+
         self._tolerance = tolerance
-        self._initialize_vertex_data(start_vertex)
-        self._relax_edges()
+        start_idx = -1 if start_vertex is None else self._idx[start_vertex]
+
+        self._initialize_vertex_data(start_idx)
+        self._latest_relaxed_vertex = _relax(
+            self._indptr,
+            self._indices,
+            self._weights,
+            self._distance,
+            self._predecessor,
+            start_idx,
+            self._tolerance
+        )
 
     def reset(self) -> None:
         """
         Resets the encapsulated distance and predecessor data to allow for 
         additional shortest path searches.
         """
-        self._distance = {}
-        self._predecessor = {}
-        self._tolerance = None
\ No newline at end of file
+        self._distance.fill(INF)
+        self._predecessor.fill(-1)
+        self._tolerance = None
+        self._latest_relaxed_vertex = None
\ No newline at end of file
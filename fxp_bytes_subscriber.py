@@ -4,17 +4,30 @@ Module defining helper functions for forex subscriber.
 Authors: Joshua Scheck
 Version: 2022-11-22
 """
-from array import array
-from datetime import datetime, timedelta
+from datetime import datetime
 import socket
 import struct
-from typing import Any, List, NamedTuple, Tuple
+import sys
+from typing import Dict, List, NamedTuple, Tuple
 
+import numpy as np
 
-# Number of micros per second
-MICROS_PER_SECOND = 1_000_000
+
+# Big-endian layout of a subscriber address, IPv4 host followed by port
+ADDRESS_STRUCT = struct.Struct("!4sH")
 # Number of bytes in the published quote message
 MESSAGE_SIZE = 32
+# Layout of a published quote message. The timestamp is sent big-endian, while
+# the exchange rate is sent in the publisher's native byte order.
+QUOTE_DTYPE = np.dtype([
+    ("timestamp", ">u8"),
+    ("src_currency", "S3"),
+    ("dest_currency", "S3"),
+    ("exch_rate", np.float64),
+    ("padding", "V10")
+])
+# Decoded currency codes, keyed by their serialized form
+_CURRENCY_CACHE: Dict[bytes, str] = {}
 
 
 class PublishedQuote(NamedTuple):
@@ -28,39 +41,24 @@ class PublishedQuote(NamedTuple):
     exch_rate: float
 
 
-def deserialize_message(typecode: str, message: bytes) -> Any:
+def _decode_currency(code: bytes) -> str:
     """
-    Extracts a message from a byte array (serialized message).
+    Decodes a serialized currency code. Codes that were seen before resolve to
+    the same interned string without decoding them again.
 
     Args:
-        typecode (str): Character representing the expecting type of data
-            encapsulated by the serialized message.
-        message (bytes): Reference message to deserialize.
+        code (bytes): Serialized 3-letter currency code.
 
     Returns:
-        Any: The constructed message.
-    """
-    arr = array(typecode)
-    arr.frombytes(message)
-    arr.byteswap()
-    return arr[0]
-
-
-def deserialize_utcdatetime(message: bytes) -> datetime:
+        str: The decoded currency code.
     """
-    Constructs a UTC timestamp from a byte array.
+    currency = _CURRENCY_CACHE.get(code)
 
-    Args:
-        message (bytes): Serialized message to extract UTC time stamp from.
-
-    Returns:
-        datetime: Extracted UTC timestamp. 
-    """
-    epoch = datetime(1970, 1, 1)
-    microsecs = int(deserialize_message('Q', message))
+    if currency is None:
+        currency = sys.intern(code.decode("ascii"))
+        _CURRENCY_CACHE[code] = currency
 
-    seconds = microsecs / MICROS_PER_SECOND
-    return epoch + timedelta(seconds=seconds)
+    return currency
 
 
 def unmarshal_message(message: bytes) -> List[PublishedQuote]:
@@ -69,25 +67,30 @@ def unmarshal_message(message: bytes) -> List[PublishedQuote]:
 
     Args:
         message (bytes): Serialized message to collected published quotes from.
+            Any bytes-like object, such as a memoryview, is accepted.
 
     Returns:
         List[PublishedQuote]: Extracted published quotes.
     """
-    published_quotes = []
-
-    for idx in range(0, len(message), MESSAGE_SIZE):
-        curr_msg = message[idx:idx+MESSAGE_SIZE]
-
-        timestamp = deserialize_utcdatetime(curr_msg[0:8])
-        curr1 = curr_msg[8:11].decode("utf-8")
-        curr2 = curr_msg[11:14].decode("utf-8")
-        rate = float(struct.unpack('d', curr_msg[14:22])[0])
-
-        published_quotes.append(
-            PublishedQuote(timestamp, curr1, curr2, rate)
+    # Decode every quote of the message at once
+    records = np.frombuffer(
+        message, dtype=QUOTE_DTYPE, count=len(message) // MESSAGE_SIZE
+    )
+
+    timestamps = records["timestamp"].astype(np.int64)\
+        .astype("datetime64[us]").tolist()
+    src_currencies = records["src_currency"].tolist()
+    dest_currencies = records["dest_currency"].tolist()
+    exch_rates = records["exch_rate"].tolist()
+
+    return [
+        PublishedQuote(
+            timestamp, _decode_currency(curr1), _decode_currency(curr2), rate
         )
-
-    return published_quotes
+        for timestamp, curr1, curr2, rate in zip(
+            timestamps, src_currencies, dest_currencies, exch_rates
+        )
+    ]
 
 
 def serialize_address(client_address: Tuple[str, int]) -> bytes:
@@ -95,7 +98,7 @@ def serialize_address(client_address: Tuple[str, int]) -> bytes:
     Constructs a serialized message containing the listener address of the
     subscriber.
 
-    >>> serialize_address('127.0.0.1', 65534)
+    >>> serialize_address(('127.0.0.1', 65534))
     b'\\x7f\\x00\\x00\\x01\\xff\\xfe'
 
     Args:
@@ -106,12 +109,5 @@ def serialize_address(client_address: Tuple[str, int]) -> bytes:
         bytes: The resulting 6-byte serialized message.
     """
     host, port = client_address
-    host_bytes = socket.inet_aton(host)
-
-    p = array('H', [port])
-    p.byteswap()  # to big-endian
-    port_bytes = p.tobytes()
-
-    address_bytes = host_bytes + port_bytes
 
-    return address_bytes
\ No newline at end of file
+    return ADDRESS_STRUCT.pack(socket.inet_aton(host), port)
\ No newline at end of file
@@ -5,8 +5,11 @@ Authors: Joshua Scheck
 Version: 2022-11-22
 """
 from argparse import ArgumentParser
-from copy import deepcopy
-from datetime import datetime
+from datetime import datetime, timedelta
+import heapq
+import logging
+import math
+import selectors
 import socket
 from typing import Dict, List, Tuple
 
@@ -20,12 +23,18 @@ from fxp_bytes_subscriber import (
 
 # UDP receive buffer size
 UDP_BUFFER_SIZE = 4096
+# Maximum number of queued messages received and processed together
+MAX_RECV_BATCH = 32
+# Kernel receive buffer size of the listener socket, to absorb bursts
+LISTENER_RCVBUF_SIZE = 4 * 1024 * 1024
 # The number of seconds in a minute
 SECONDS_PER_MINUTE = 60
 # Subscription timeout
 SUB_TIMEOUT = 10 * SECONDS_PER_MINUTE
 # Number of seconds before a published quote is considered 'stale'
 STALE_QUOTE_DEF = 1.5
+# Age after which a published quote is considered 'stale'
+STALE_QUOTE_DELTA = timedelta(seconds=STALE_QUOTE_DEF)
 # Host of subscriber service
 LISTENER_HOST = "localhost"
 # Port of the subscriber service. 0 designates that a random port is chosen.
@@ -34,6 +43,9 @@ LISTENER_PORT = 0
 DEFAULT_START_CURR_VAL = 100
 
 
+logger = logging.getLogger(__name__)
+
+
 class ForexSubscriber:
     """
     Subscribes to Forex currency quote publisher and identifies arbitrage
@@ -50,34 +62,63 @@ class ForexSubscriber:
         """
         self._publisher_address = host, port
         self._listener_sock: socket.socket = None
+        self._selector: selectors.BaseSelector = None
         self._listener_addr: Tuple[str, int] = None
         self._published_quotes: Dict[str, Dict[str, QuoteData]] = {}
-        self._latest_timestamp: datetime = None
+        self._quote_timestamps: List[Tuple[datetime, str, str]] = []
+        # Earliest possible time stamp, so the first quote is never ignored
+        self._latest_timestamp = datetime.min
+        self._graph = BellmandFord(self._published_quotes)
+        self._recv_buffer = bytearray(UDP_BUFFER_SIZE * MAX_RECV_BATCH)
 
         self._start_listener()
         self._send_address_to_publisher()
         self._subscribe()
 
-    def _clean_stale_quotes(self, curr_time: datetime) -> None:
+    def _clean_stale_quotes(self, curr_time: datetime) -> bool:
         """
         Removes stale published quotes from the encapsulated weighted graph.
 
         Args:
             curr_time (datetime): Current time stamp to compare against.
+
+        Returns:
+            bool: True if any quote was removed, otherwise False.
         """
-        # Create a copy of the published quotes map for iterration 
-        ref_quotes = deepcopy(self._published_quotes)
+        removed = False
+
+        # No quotes left that could expire
+        if not self._quote_timestamps:
+            return removed
 
-        for src_curr, nested_dict in ref_quotes.items():
-            for dest_curr, (timestamp, _) in nested_dict.items():
-                if (curr_time - timestamp).total_seconds() > STALE_QUOTE_DEF:
-                    print(
-                        f"removing stale quote for ('{src_curr}', "
-                        f"'{dest_curr}')"
-                    )
+        # Quotes published before this time stamp are stale
+        threshold = curr_time - STALE_QUOTE_DELTA
 
-                    # Delete quote from published quotes map
-                    del self._published_quotes[src_curr][dest_curr]
+        # Quote timestamps are kept in a min-heap, so only the quotes that
+        # became stale need to be visited
+        while self._quote_timestamps and\
+            self._quote_timestamps[0][0] < threshold:
+            timestamp, src_curr, dest_curr = heapq.heappop(
+                self._quote_timestamps
+            )
+
+            for curr1, curr2 in ((src_curr, dest_curr), (dest_curr, src_curr)):
+                quote = self._published_quotes[curr1].get(curr2)
+
+                # Skip quotes that were replaced by a more recent quote
+                if quote is None or quote.timestamp != timestamp:
+                    continue
+
+                logger.debug(
+                    "removing stale quote for ('%s', '%s')", curr1, curr2
+                )
+
+                # Delete quote from published quotes map and graph
+                del self._published_quotes[curr1][curr2]
+                self._graph.remove_edge(curr1, curr2)
+                removed = True
+
+        return removed
 
     def _send_address_to_publisher(self) -> None:
         """
@@ -94,12 +135,52 @@ class ForexSubscriber:
         receiving UDP messages.
         """
         listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, LISTENER_RCVBUF_SIZE
+        )
         listener.bind((LISTENER_HOST, LISTENER_PORT))
-        listener.settimeout(SUB_TIMEOUT)
+
+        # Non-blocking to allow for draining queued messages, waiting for new
+        # messages is done by the selector
+        listener.setblocking(False)
+
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(listener, selectors.EVENT_READ)
 
         self._listener_sock = listener
         self._listener_addr = listener.getsockname()
 
+    def _receive_messages(self) -> List[memoryview]:
+        """
+        Waits for a message from the publisher, then receives it along with
+        any further messages that are already queued.
+
+        Raises:
+            socket.timeout: No message arrived within the subscription
+                timeout.
+
+        Returns:
+            List[memoryview]: Views of the received messages within the
+                encapsulated receive buffer.
+        """
+        if not self._selector.select(SUB_TIMEOUT):
+            raise socket.timeout()
+
+        recv_view = memoryview(self._recv_buffer)
+        messages = []
+
+        for offset in range(0, len(recv_view), UDP_BUFFER_SIZE):
+            msg_view = recv_view[offset:offset+UDP_BUFFER_SIZE]
+
+            try:
+                num_bytes = self._listener_sock.recv_into(msg_view)
+            except BlockingIOError:
+                break
+
+            messages.append(msg_view[:num_bytes])
+
+        return messages
+
     def _get_exchange_rate(self, src_curr: str, dest_curr: str) -> float:
         """
         Retrieves the exchange rate for the pair of currencies
@@ -148,38 +229,40 @@ class ForexSubscriber:
         Check if there are any arbitrages in the published quotes. Only the
         first occurance of an arbitrage opportunity is displayed.
         """
-        self._graph = BellmandFord(self._published_quotes)
-        
-        for currency in self._published_quotes.keys():
-            self._graph.shortest_paths(currency)
-            neg_cycle = self._graph.get_negative_cycle()
+        # A single search from the virtual source covers every currency
+        self._graph.shortest_paths()
+        neg_cycle = self._graph.get_negative_cycle()
 
-            # Escape out for first arbitrage opportunity found.
-            if len(neg_cycle) > 0:
-                self._report_arbitrage(neg_cycle)
-                break
+        if len(neg_cycle) > 0:
+            self._report_arbitrage(neg_cycle)
 
-            self._graph.reset()
+        self._graph.reset()
 
     def _update_published_quotes(
         self, published_quotes: List[PublishedQuote]
-    ) -> None:
+    ) -> bool:
         """
         Update encapsulated published quotes.
 
         Args:
             published_quotes (List[PublishedQuote]): Extracted quotes retrieved
                 from forex publisher.
+
+        Returns:
+            bool: True if any quote was stored, otherwise False.
         """
-        if self._latest_timestamp is None:
-            self._latest_timestamp = published_quotes[0].timestamp
+        updated = False
 
         for timestamp, src_curr, dest_curr, rate in published_quotes:
-            print(timestamp, src_curr, dest_curr, rate)
+            # Guarded, as this runs for every quote
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "%s %s %s %s", timestamp, src_curr, dest_curr, rate
+                )
 
             # Ignore quotes that have a time stamp smaller than latest
             if self._latest_timestamp > timestamp:
-                print("ignoring out-of-sequence message")
+                logger.debug("ignoring out-of-sequence message")
                 continue
             
             # Update encapsulated timestamp
@@ -192,12 +275,38 @@ class ForexSubscriber:
             if dest_curr not in self._published_quotes:
                 self._published_quotes[dest_curr] = {}
 
-            self._published_quotes[src_curr][dest_curr] = QuoteData(
-                timestamp, rate
-            )
+            # The edge weight is computed once, when the quote is received
+            neg_log_rate = -1 * math.log(rate)
+            quote = QuoteData(timestamp, rate, neg_log_rate)
+
+            self._published_quotes[src_curr][dest_curr] = quote
             self._published_quotes[dest_curr][src_curr] = QuoteData(
-                timestamp, 1/rate
+                timestamp, 1/rate, -neg_log_rate
+            )
+            self._graph.upsert_edge(src_curr, dest_curr, quote)
+            heapq.heappush(
+                self._quote_timestamps, (timestamp, src_curr, dest_curr)
             )
+            updated = True
+
+        return updated
+
+    def _apply_quotes(self, published_quotes: List[PublishedQuote]) -> bool:
+        """
+        Removes the quotes that became stale and stores the newly published
+        quotes.
+
+        Args:
+            published_quotes (List[PublishedQuote]): Extracted quotes retrieved
+                from forex publisher.
+
+        Returns:
+            bool: True if the published quotes changed, otherwise False.
+        """
+        removed = self._clean_stale_quotes(self._latest_timestamp)
+        updated = self._update_published_quotes(published_quotes)
+
+        return removed or updated
 
     def _subscribe(self) -> None:
         """
@@ -206,19 +315,26 @@ class ForexSubscriber:
         # Subscriber waits for messages from publisher
         try:
             while True:
-                data = self._listener_sock.recv(UDP_BUFFER_SIZE)
+                changed = False
+
+                # Messages that queued up are applied together, so the
+                # arbitrage check only runs once for them
+                for message in self._receive_messages():
+                    published_quotes = unmarshal_message(message)
 
-                published_quotes = unmarshal_message(data)
+                    if self._apply_quotes(published_quotes):
+                        changed = True
 
-                self._clean_stale_quotes(self._latest_timestamp)
-                self._update_published_quotes(published_quotes)
-                self._check_for_arbitrages()
+                # An unchanged graph cannot reveal a new arbitrage
+                if changed:
+                    self._check_for_arbitrages()
         
         except socket.timeout:
             print(f"Subscription timed out")
 
         finally:
             # Close listener socket at the end of subscription
+            self._selector.close()
             self._listener_sock.close()
 
 
@@ -247,7 +363,18 @@ if __name__ == "__main__":
         type=int,
         help="The port number the forex publisher is running on."
     )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Display every received quote and discarded quote."
+    )
 
     parsed_args = parser.parse_args()
 
+    logging.basicConfig(
+        format="%(message)s",
+        level=logging.DEBUG if parsed_args.verbose else logging.INFO
+    )
+
     fxp_sub = ForexSubscriber(parsed_args.host, parsed_args.port)
\ No newline at end of file